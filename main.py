@@ -2,19 +2,18 @@ import asyncio
 import logging
 import os
 import sys
+from pathlib import Path
+from logging.handlers import RotatingFileHandler
 import sqlite3
-from aiohttp import web
+import threading
 
-from aiogram import Bot, Dispatcher, types, F, Router
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram import Bot, Dispatcher, types, F
+from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 import config
 
@@ -26,34 +25,191 @@ WEB_SERVER_HOST = "127.0.0.1"
 WEB_SERVER_PORT = 8080
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_SECRET = config.WEBHOOK_SECRET
+WEBHOOK_MAX_CONNECTIONS = 100
 BASE_WEBHOOK_URL = f"https://{config.SERVER_ADDRESS}:{WEB_SERVER_PORT}"
 
 # Logging configuration
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+LOG_FILE = "bot.log"
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[
+        logging.StreamHandler(sys.stdout),
+        RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8"),
+    ]
+)
 logger = logging.getLogger(__name__)
 
 # Database setup
-DB_FILE = "receipts_contest.db"
+# During contest bursts DB_FILE can point at tmpfs (e.g. /dev/shm) with DB_BACKUP_FILE on persistent disk
+DB_FILE = os.environ.get("DB_FILE", "receipts_contest.db")
+DB_BACKUP_FILE = os.environ.get("DB_BACKUP_FILE")
+DB_BACKUP_INTERVAL = 30
+db_backup_task = None
+DB_CONN = None
+DB_LOCK = threading.Lock()
+
+# SQLite allows a single writer; reads go through a small pool that WAL keeps from blocking on it
+DB_READER_COUNT = 4
+DB_READERS = None
+
+# Reusing the same SQL string lets sqlite3 serve it from its prepared statement cache
+# Users without a Telegram username are stored as 'No Username'
+INSERT_SQL = (
+    "INSERT INTO receipts (user_id, user_name, name, contact, city, photo_id) "
+    "VALUES (?, COALESCE(?, 'No Username'), ?, ?, ?, ?)"
+)
+
+# Receipts are queued by handlers and written in batches, one transaction per batch
+BATCH_WINDOW = 0.02
+receipt_queue = None
+receipt_writer_task = None
+receipt_writer_stopped = False
 
 def init_db():
-    """Initialize the database if it does not exist."""
-    if not os.path.exists(DB_FILE):
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS receipts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_name TEXT,
-                name TEXT,
-                contact TEXT,
-                city TEXT,
-                photo_id TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized.")
+    """Open the writer and reader connections and create the schema if it is missing."""
+    global DB_CONN, DB_READERS
+    # tmpfs does not survive a reboot, so start from the last snapshot instead of an empty database
+    if DB_BACKUP_FILE and not os.path.exists(DB_FILE) and os.path.exists(DB_BACKUP_FILE):
+        _copy_db(DB_BACKUP_FILE, DB_FILE)
+        logger.info("Database restored from %s.", DB_BACKUP_FILE)
+
+    # One connection for the lifetime of the process, in autocommit mode
+    DB_CONN = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    # Pragmas first, since journal_mode cannot change inside a transaction; the schema is created atomically
+    # wal_autocheckpoint and journal_size_limit checkpoint less often during bursts without letting the WAL grow unbounded
+    DB_CONN.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA busy_timeout=5000;
+        PRAGMA wal_autocheckpoint=4000;
+        PRAGMA journal_size_limit=67108864;
+
+        BEGIN;
+        CREATE TABLE IF NOT EXISTS receipts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_name TEXT DEFAULT 'No Username',
+            name TEXT,
+            contact TEXT,
+            city TEXT,
+            photo_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_receipts_user ON receipts(user_id);
+        CREATE TABLE IF NOT EXISTS updates (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_id INTEGER
+        );
+        COMMIT;
+    ''')
+
+    # as_uri() percent-encodes characters such as ?, # and % that would otherwise end the path
+    reader_uri = Path(DB_FILE).absolute().as_uri() + "?mode=ro"
+    DB_READERS = asyncio.Queue()
+    for _ in range(DB_READER_COUNT):
+        DB_READERS.put_nowait(sqlite3.connect(reader_uri, uri=True, check_same_thread=False))
+    logger.info("Database initialized.")
+
+async def close_db():
+    """Close the reader and writer connections; closing the last one checkpoints the WAL."""
+    while not DB_READERS.empty():
+        DB_READERS.get_nowait().close()
+    with DB_LOCK:
+        DB_CONN.close()
+    logger.info("Database closed.")
+
+def _copy_db(source_file, target_file):
+    """Copy a database file with the sqlite3 online backup API."""
+    source = sqlite3.connect(source_file)
+    target = sqlite3.connect(target_file)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+async def db_backup_loop():
+    """Snapshot the database to DB_BACKUP_FILE every DB_BACKUP_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(DB_BACKUP_INTERVAL)
+        try:
+            await asyncio.to_thread(_copy_db, DB_FILE, DB_BACKUP_FILE)
+        except Exception as e:
+            logger.error("Error backing up database: %s", e)
+
+def _execute_write(sql, params) -> int:
+    with DB_LOCK:
+        return DB_CONN.execute(sql, params).lastrowid
+
+async def db_write(sql, params=()) -> int:
+    """Execute a statement on the writer connection and return the last row ID."""
+    return await asyncio.to_thread(_execute_write, sql, params)
+
+async def db_read(sql, params=()) -> list:
+    """Run a query on a pooled reader connection and return all rows."""
+    conn = await DB_READERS.get()
+    try:
+        return await asyncio.to_thread(lambda: conn.execute(sql, params).fetchall())
+    finally:
+        DB_READERS.put_nowait(conn)
+
+def _insert_receipts(rows) -> list:
+    """Insert a batch of receipts in a single transaction and return their IDs. Runs in a worker thread."""
+    with DB_LOCK:
+        DB_CONN.execute("BEGIN")
+        try:
+            # executemany() does not report row IDs, so run the cached statement per row instead
+            receipt_ids = [DB_CONN.execute(INSERT_SQL, row).lastrowid for row in rows]
+        except Exception:
+            DB_CONN.execute("ROLLBACK")
+            raise
+        DB_CONN.execute("COMMIT")
+        return receipt_ids
+
+async def _flush_receipts(batch):
+    """Write queued receipts and resolve the futures of the handlers waiting on them."""
+    rows = [row for row, _ in batch]
+    try:
+        receipt_ids = await asyncio.to_thread(_insert_receipts, rows)
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), receipt_id in zip(batch, receipt_ids):
+        if not future.done():
+            future.set_result(receipt_id)
+
+async def receipt_writer():
+    """Wait for a receipt, collect whatever else arrives within BATCH_WINDOW seconds and commit them together.
+
+    Stops after flushing once a None sentinel is taken off the queue.
+    """
+    while True:
+        item = await receipt_queue.get()
+        if item is None:
+            return
+        batch = [item]
+        await asyncio.sleep(BATCH_WINDOW)
+        stopping = False
+        while not receipt_queue.empty():
+            item = receipt_queue.get_nowait()
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+        await _flush_receipts(batch)
+        if stopping:
+            return
+
+async def save_receipt(*row) -> int:
+    """Queue a receipt for the background writer and wait for its ID."""
+    if receipt_writer_stopped:
+        # Handlers still running during shutdown write their receipt directly, since nothing drains the queue
+        receipt_ids = await asyncio.to_thread(_insert_receipts, [row])
+        return receipt_ids[0]
+    future = asyncio.get_running_loop().create_future()
+    receipt_queue.put_nowait((row, future))
+    return await future
 
 # FSM States
 class ReceiptForm(StatesGroup):
@@ -62,80 +218,100 @@ class ReceiptForm(StatesGroup):
     waiting_for_city = State()
     waiting_for_photo = State()
 
-# Router
-router = Router()
+# FSM storage: Redis lets several webhook replicas share form state, memory is enough for a single process
+REDIS_URL = getattr(config, "REDIS_URL", None)
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(REDIS_URL)
+else:
+    storage = MemoryStorage()
 
-# Helper function for cancel button
-def get_cancel_button():
-    buttons = InlineKeyboardBuilder()
-    buttons.add(InlineKeyboardButton(text="Cancel", callback_data="cancel"))
-    return buttons
+# Dispatcher
+dp = Dispatcher(storage=storage)
+
+# Prompts sent at each step of the form
+WELCOME_TEXT = (
+    "Добро пожаловать в бот Розыгрыша от Tapioca! 🎉\n"
+    "Как Вас зовут?"
+)
+CONTACT_PROMPT = "Отправьте пожалуйста Ваш номер телефона."
+CITY_PROMPT = "Из какого города вы?"
+PHOTO_PROMPT = "Пожалуйста отправьте фото чека."
+
+# Cancel button markup, built once and shared by all prompts
+CANCEL_MARKUP = InlineKeyboardBuilder().add(InlineKeyboardButton(text="Cancel", callback_data="cancel")).as_markup()
 
 # Handlers
-@router.message(CommandStart())
+@dp.message(CommandStart())
 async def start_command(message: types.Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} ({message.from_user.username}) started interaction.")
-    await message.answer(
-        "Добро пожаловать в бот Розыгрыша от Tapioca! 🎉\n"
-        "Как Вас зовут?",
-        reply_markup=get_cancel_button().as_markup()
-    )
+    logger.info("User %s (%s) started interaction.", message.from_user.id, message.from_user.username)
+    await message.answer(WELCOME_TEXT, reply_markup=CANCEL_MARKUP)
     await state.set_state(ReceiptForm.waiting_for_name)
 
-@router.message(ReceiptForm.waiting_for_name)
 async def handle_name_input(message: types.Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} provided name: {message.text.strip()}")
-    await state.update_data(name=message.text.strip())
-    await message.answer("Отправьте пожалуйста Ваш номер телефона.", reply_markup=get_cancel_button().as_markup())
+    text = message.text.strip()
+    logger.info("User %s provided name: %s", message.from_user.id, text)
+    await state.update_data(name=text)
+    await message.answer(CONTACT_PROMPT, reply_markup=CANCEL_MARKUP)
     await state.set_state(ReceiptForm.waiting_for_contact)
 
-@router.message(ReceiptForm.waiting_for_contact)
 async def handle_contact_input(message: types.Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} provided contact: {message.text.strip()}")
-    await state.update_data(contact=message.text.strip())
-    await message.answer("Из какого города вы?", reply_markup=get_cancel_button().as_markup())
+    text = message.text.strip()
+    logger.info("User %s provided contact: %s", message.from_user.id, text)
+    await state.update_data(contact=text)
+    await message.answer(CITY_PROMPT, reply_markup=CANCEL_MARKUP)
     await state.set_state(ReceiptForm.waiting_for_city)
 
-@router.message(ReceiptForm.waiting_for_city)
 async def handle_city_input(message: types.Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} provided city: {message.text.strip()}")
-    await state.update_data(city=message.text.strip())
-    await message.answer("Пожалуйста отправьте фото чека.", reply_markup=get_cancel_button().as_markup())
+    text = message.text.strip()
+    logger.info("User %s provided city: %s", message.from_user.id, text)
+    await state.update_data(city=text)
+    await message.answer(PHOTO_PROMPT, reply_markup=CANCEL_MARKUP)
     await state.set_state(ReceiptForm.waiting_for_photo)
 
-@router.message(ReceiptForm.waiting_for_photo, F.photo)
 async def handle_photo_input(message: types.Message, state: FSMContext):
+    if not message.photo:
+        return
     photo_id = message.photo[-1].file_id
     user_data = await state.get_data()
-    logger.info(f"User {message.from_user.id} uploaded photo with ID: {photo_id}")
+    logger.info("User %s uploaded photo with ID: %s", message.from_user.id, photo_id)
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO receipts (user_id, user_name, name, contact, city, photo_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (message.from_user.id, message.from_user.username or "No Username", user_data['name'], user_data['contact'], user_data['city'], photo_id))
-        receipt_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-
-        logger.info(f"Receipt saved with ID: {receipt_id} for user {message.from_user.id}")
+        receipt_id = await save_receipt(
+            message.from_user.id, message.from_user.username,
+            user_data['name'], user_data['contact'], user_data['city'], photo_id
+        )
+
+        logger.info("Receipt saved with ID: %s for user %s", receipt_id, message.from_user.id)
         await message.answer(
             f"Спасибо за оставленную заявку! Вы стали участником розыгрыша от Tapioca. 🎉\n"
             f"Ваш номер заявки: {receipt_id}\n"
             "Хотите оставить еще одну заявку? Нажмите /start."
         )
     except Exception as e:
-        logger.error(f"Error saving receipt: {e}")
+        logger.error("Error saving receipt: %s", e)
         await message.answer("Произошла ошибка. Попробуйте еще раз.")
 
     await state.clear()
 
-@router.callback_query(lambda query: query.data == "cancel")
+# Form step handlers keyed by state, so each message costs one filter check and a dict lookup
+FORM_STEPS = {
+    ReceiptForm.waiting_for_name.state: handle_name_input,
+    ReceiptForm.waiting_for_contact.state: handle_contact_input,
+    ReceiptForm.waiting_for_city.state: handle_city_input,
+    ReceiptForm.waiting_for_photo.state: handle_photo_input,
+}
+
+@dp.message(StateFilter(ReceiptForm))
+async def handle_form_input(message: types.Message, state: FSMContext, raw_state: str | None):
+    """Route the message to the handler for the current form step."""
+    # raw_state is the state FSMContextMiddleware already loaded, so storage is not read twice
+    await FORM_STEPS[raw_state](message, state)
+
+@dp.callback_query(F.data == "cancel")
 async def handle_cancel(callback_query: types.CallbackQuery, state: FSMContext):
     """Handle user cancellation."""
-    logger.info(f"User {callback_query.from_user.id} canceled the submission process.")
+    logger.info("User %s canceled the submission process.", callback_query.from_user.id)
     await state.clear()
     await callback_query.message.answer(
         "Заявка отклонена. Вы можете начать заново нажав /start.",
@@ -143,30 +319,126 @@ async def handle_cancel(callback_query: types.CallbackQuery, state: FSMContext):
     )
     await callback_query.answer()
 
+# Receipt writer lifecycle
+async def start_receipt_writer():
+    global receipt_queue, receipt_writer_task, receipt_writer_stopped
+    receipt_queue = asyncio.Queue()
+    receipt_writer_stopped = False
+    receipt_writer_task = asyncio.create_task(receipt_writer())
+    logger.info("Receipt writer started.")
+
+async def stop_receipt_writer():
+    global receipt_writer_stopped
+    # From here on save_receipt() bypasses the queue, so nothing is queued after the final drain
+    receipt_writer_stopped = True
+
+    # A sentinel instead of cancel(), so an in-flight batch still resolves its handlers' futures
+    receipt_queue.put_nowait(None)
+    await receipt_writer_task
+
+    # Persist anything queued after the sentinel
+    batch = []
+    while not receipt_queue.empty():
+        batch.append(receipt_queue.get_nowait())
+    if batch:
+        await _flush_receipts(batch)
+    logger.info("Receipt writer stopped.")
+
+# Database backup lifecycle
+async def start_db_backup():
+    global db_backup_task
+    db_backup_task = asyncio.create_task(db_backup_loop())
+    logger.info("Database backups to %s started.", DB_BACKUP_FILE)
+
+async def stop_db_backup():
+    db_backup_task.cancel()
+    try:
+        await db_backup_task
+    except asyncio.CancelledError:
+        pass
+
+    # Final snapshot after the receipt writer has flushed
+    try:
+        await asyncio.to_thread(_copy_db, DB_FILE, DB_BACKUP_FILE)
+    except Exception as e:
+        logger.error("Error backing up database: %s", e)
+    logger.info("Database backups stopped.")
+
 # Webhook setup
 async def on_startup(bot: Bot):
-    await bot.set_webhook(f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    await bot.set_webhook(
+        f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=False
+    )
     logger.info("Webhook has been set.")
 
+# Polling setup
+# Only pending updates this close below the saved ID count as already handled. Telegram restarts
+# update IDs at a random value after a week without updates, so a stale ID must not skip new ones.
+UPDATE_ID_WINDOW = 100
+
+async def save_update_id(handler, event: types.Update, data):
+    """Remember the last handled update so a restart does not handle it again."""
+    result = await handler(event, data)
+    await db_write(
+        "INSERT INTO updates (id, last_id) VALUES (1, ?) "
+        "ON CONFLICT(id) DO UPDATE SET last_id = excluded.last_id",
+        (event.update_id,)
+    )
+    return result
+
 async def polling(dp, bot):
-    await dp.start_polling(bot, skip_updates=False)
+    rows = await db_read("SELECT last_id FROM updates WHERE id = 1")
+    if rows:
+        # Peek without an offset, which confirms nothing, and skip only updates handled before the restart
+        last_id = rows[0][0]
+        # Confirming an offset drops every update below it, so stop at the first one not handled yet
+        handled = []
+        for update in await bot.get_updates(timeout=0):
+            if not last_id - UPDATE_ID_WINDOW < update.update_id <= last_id:
+                break
+            handled.append(update.update_id)
+        if handled:
+            await bot.get_updates(offset=handled[-1] + 1, limit=1, timeout=0)
+            logger.info("Skipped %s updates already handled before the restart.", len(handled))
+
+    await dp.start_polling(bot)
 
 
 # Main function
 def main():
+    # uvloop is not available on Windows; fall back to the default event loop there
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     init_db()
 
-    # Dispatcher
-    dp = Dispatcher()
-    dp.include_router(router)
+    dp.startup.register(start_receipt_writer)
+    dp.shutdown.register(stop_receipt_writer)
+    if DB_BACKUP_FILE:
+        dp.startup.register(start_db_backup)
+        dp.shutdown.register(stop_db_backup)
+    # After the writer has flushed and the final snapshot has been taken
+    dp.shutdown.register(close_db)
 
     if config.PROD:
         dp.startup.register(on_startup)
+    else:
+        dp.update.outer_middleware(save_update_id)
 
-    # Bot instance
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Bot instance; no default parse mode, since all replies are plain text
+    bot = Bot(token=TOKEN)
 
     if config.PROD:
+        # Only needed for the webhook server, so polling deployments skip importing them
+        from aiohttp import web
+        from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
         # Web application
         app = web.Application()
         webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)